@@ -1,16 +1,35 @@
+"""
+Dataset augmentation script: asks a local LLM served by Ollama to write messy,
+realistic variations of each prompt in the seed dataset.
+
+For best throughput, start the Ollama server with, e.g.:
+
+    OLLAMA_NUM_PARALLEL=8 OLLAMA_MAX_LOADED_MODELS=1 ollama serve
+
+OLLAMA_NUM_PARALLEL should be at least CONCURRENCY so requests are served in
+parallel rather than queued, and OLLAMA_MAX_LOADED_MODELS=1 keeps the whole
+GPU for the augmentation model.
+"""
+
 import os
 import json
-import time
-import re
+import asyncio
 import argparse
-from openai import OpenAI
+import itertools
+import string
+from time import monotonic
+from typing import Iterable, Iterator, List, Optional
+from openai import AsyncOpenAI, BadRequestError
 from tqdm import tqdm
 
+from jsonl_utils import fadvise, json_dumps, json_loads
+
+
 # --- CONFIGURATION ---
 
 # Point the client to your local Ollama server
 # This is the "magic" that makes it use your local model
-client = OpenAI(
+client = AsyncOpenAI(
     base_url='http://localhost:11434/v1',
     api_key='ollama',  # required, but the value can be anything
 )
@@ -21,15 +40,38 @@ DESTINATION_FILE = "data/augmented_dataset.jsonl"
 MODEL_TO_USE = "llama3:8b" # Or "phi3:mini", etc.
 VARIATIONS_PER_ENTRY = 4 # How many messy versions to create for each clean one
 
+# How many requests to keep in flight at once. Ollama only serves them in
+# parallel if the server is started with OLLAMA_NUM_PARALLEL >= CONCURRENCY,
+# e.g. `OLLAMA_NUM_PARALLEL=8 ollama serve`; otherwise they are queued.
+CONCURRENCY = int(os.getenv("CONCURRENCY", 8))
+
+# How many data points to augment with a single request. Batching amortizes
+# the long meta-prompt over several entries; larger batches need a model that
+# reliably returns well-formed JSON for all of them.
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 4))
+
+# Generation budget per data point in a request. Variations are short, and
+# capping the output keeps a rambling model from burning decode time.
+MAX_TOKENS_PER_ENTRY = 256
+
+# Optional minimum spacing, in seconds, between request starts for servers
+# that need gentler treatment. 0 disables pacing; the semaphore alone then
+# bounds the load.
+MIN_REQUEST_INTERVAL = float(os.getenv("MIN_REQUEST_INTERVAL", 0))
+
+# How long Ollama keeps the model loaded after a request. Sent with every
+# request so the model stays resident for the whole run.
+KEEP_ALIVE = "30m"
+
 def get_meta_prompt():
     """
     Returns the master prompt template used to guide the LLM.
     This is where we tell the AI how to behave.
     """
     return """
-You are a data augmentation specialist for a machine learning project. Your task is to create realistic, varied, and sometimes "messy" user prompts based on a perfect, "textbook" example.
+You are a data augmentation specialist for a machine learning project. Your task is to create realistic, varied, and sometimes "messy" user prompts based on perfect, "textbook" examples.
 
-Your goal is to generate {VARIATIONS_PER_ENTRY} alternative prompts for the provided CadQuery script. These alternative prompts must correspond to the EXACT same output code.
+Your goal is to generate $variations alternative prompts for each of the provided CadQuery scripts. These alternative prompts must correspond to the EXACT same output code as the data point they were generated from.
 
 The variations should include a mix of the following styles:
 1.  **Casual Synonyms & Slang:** Use words like "thingy," "block," "slab," "cutout" instead of formal terms.
@@ -41,70 +83,281 @@ Here is an example of the desired output:
 
 ---
 **EXAMPLE INPUT:**
-{{
-  "instruction": "Create a thin rectangular plate",
-  "input": "Make a flat plate 50mm by 30mm with 2mm thickness",
-  "output": "import cadquery as cq\\n\\nresult = cq.Workplane(\\"XY\\").box(50, 30, 2)"
-}}
-
-**EXAMPLE DESIRED OUTPUT:**
 [
-  "a 50 by 30 slab, make it 2mm high",
-  "hey can u generate a flat plate for me 50mm x 30mm but only 2mm thick?",
-  "plate 50 30 2",
-  "Make flat plat 50mm by 30mm with 2mm thicknes"
+  {
+    "id": 0,
+    "instruction": "Create a thin rectangular plate",
+    "input": "Make a flat plate 50mm by 30mm with 2mm thickness",
+    "output": "import cadquery as cq\\n\\nresult = cq.Workplane(\\"XY\\").box(50, 30, 2)"
+  }
 ]
+
+**EXAMPLE DESIRED OUTPUT:**
+{
+  "results": [
+    {
+      "id": 0,
+      "variations": [
+        "a 50 by 30 slab, make it 2mm high",
+        "hey can u generate a flat plate for me 50mm x 30mm but only 2mm thick?",
+        "plate 50 30 2",
+        "Make flat plat 50mm by 30mm with 2mm thicknes"
+      ]
+    }
+  ]
+}
 ---
 
-Now, generate {VARIATIONS_PER_ENTRY} variations for the following data point. Please provide your response ONLY as a valid JSON list of strings, with no other text before or after it.
+Now, generate $variations variations for each of the following $count data points. Please provide your response ONLY as a valid JSON object whose "results" list contains one object per data point, each with the data point's "id" and its list of "variations", with no other text before or after it.
 
-**DATA POINT TO AUGMENT:**
-{{
-  "instruction": "{instruction}",
-  "input": "{input}",
-  "output": "{output}"
-}}
+**DATA POINTS TO AUGMENT:**
+$data_points
 """
 
-def generate_variations(data_point: dict) -> list[str]:
-    """Calls the local LLM API to generate prompt variations."""
-    prompt_template = get_meta_prompt()
-    
-    full_prompt = prompt_template.format(
-        VARIATIONS_PER_ENTRY=VARIATIONS_PER_ENTRY,
-        instruction=data_point['instruction'],
-        input=data_point['input'],
-        output=data_point['output']
+# Built once at import with the fixed settings baked in; only the per-batch
+# fields are substituted per request.
+_META_PROMPT = string.Template(
+    string.Template(get_meta_prompt()).safe_substitute(variations=VARIATIONS_PER_ENTRY)
+)
+
+class RequestPacer:
+    """
+    Spaces request starts at least `interval` seconds apart. Only the part of
+    the interval that hasn't already elapsed is slept, so slow requests are
+    never delayed further.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_start = 0.0
+
+    async def wait(self) -> None:
+        if self.interval <= 0:
+            return
+        now = monotonic()
+        # Reserve a slot before sleeping; there is no await in between, so
+        # concurrent callers get distinct slots
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+_pacer = RequestPacer(MIN_REQUEST_INTERVAL)
+
+# Whether the server accepts response_format; cleared the first time a
+# request it rejected goes through without it.
+_json_mode_supported = True
+
+class JsonlWriter:
+    """
+    Buffers serialized JSONL blocks in memory and writes them out in chunks,
+    so each block costs a list append rather than a separate write call.
+    """
+
+    def __init__(self, path: str, flush_every: int = 256):
+        self.f_out = open(path, 'w', buffering=1 << 20)
+        self.flush_every = flush_every
+        self.buffer: list[str] = []
+        self.pending_lines = 0
+
+    @staticmethod
+    def serialize(records: list[dict]) -> str:
+        """Serializes records into a block of JSONL text."""
+        return ''.join([json_dumps(record) + '\n' for record in records])
+
+    def add_serialized(self, block: str, line_count: int) -> None:
+        self.buffer.append(block)
+        self.pending_lines += line_count
+        if self.pending_lines >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.f_out.write(''.join(self.buffer))
+            self.buffer.clear()
+            self.pending_lines = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.f_out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+async def create_json_completion(**kwargs):
+    """
+    Requests a completion constrained to a JSON object. If the server rejects
+    the request, it is retried without response_format; only if that retry
+    succeeds is JSON mode dropped for all later requests, so other bad
+    requests (e.g. an oversized batch) still fail as before.
+    """
+    global _json_mode_supported
+    await _pacer.wait()
+    if not _json_mode_supported:
+        return await client.chat.completions.create(**kwargs)
+
+    try:
+        return await client.chat.completions.create(
+            response_format={"type": "json_object"}, **kwargs
+        )
+    except BadRequestError as e:
+        json_mode_error = e
+
+    await _pacer.wait()
+    response = await client.chat.completions.create(**kwargs)
+    # Several requests can fail concurrently; only the first one warns
+    if _json_mode_supported:
+        _json_mode_supported = False
+        print(f"\nWarning: JSON mode not supported by the server, continuing without it: {json_mode_error}")
+    return response
+
+async def request_variations(data_points: list[dict]) -> Optional[List[Optional[List[str]]]]:
+    """
+    Calls the local LLM API once for a batch of data points.
+
+    Returns one list of variations per data point, with None for any data point
+    the LLM left out of its answer, or None if the response could not be parsed.
+    """
+    numbered_points = [
+        {
+            "id": i,
+            "instruction": data_point['instruction'],
+            "input": data_point['input'],
+            "output": data_point['output'],
+        }
+        for i, data_point in enumerate(data_points)
+    ]
+
+    full_prompt = _META_PROMPT.substitute(
+        count=len(data_points),
+        data_points=json.dumps(numbered_points, indent=2, ensure_ascii=False),
     )
-    
+
     try:
-        response = client.chat.completions.create(
+        response = await create_json_completion(
             model=MODEL_TO_USE,
             messages=[{"role": "user", "content": full_prompt}],
             temperature=0.8, # Encourage creativity
+            max_tokens=MAX_TOKENS_PER_ENTRY * len(data_points),
+            extra_body={"keep_alive": KEEP_ALIVE},
         )
         
         response_text = response.choices[0].message.content
         
-        # A robust way to find the JSON list inside the LLM's response
-        json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-        if not json_match:
-            print(f"\nWarning: Could not find a JSON list in the LLM response: {response_text}")
-            return []
+        # In JSON mode the response is exactly one object; without it, trim
+        # any text the model put around the object
+        start, end = response_text.find('{'), response_text.rfind('}')
+        if start == -1 or end < start:
+            print(f"\nWarning: Could not find a JSON object in the LLM response: {response_text}")
+            return None
             
-        variations = json.loads(json_match.group(0))
+        # Parse off the event loop so a large response doesn't stall the
+        # other in-flight requests
+        payload = await asyncio.to_thread(json_loads, response_text[start:end + 1])
+        entries = payload.get("results") if isinstance(payload, dict) else None
         
-        if isinstance(variations, list) and all(isinstance(i, str) for i in variations):
-            return variations
-        else:
+        if not isinstance(entries, list):
             print(f"\nWarning: LLM returned unexpected format: {response_text}")
-            return []
+            return None
+
+        results: List[Optional[List[str]]] = [None] * len(data_points)
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            entry_id = entry.get("id")
+            variations = entry.get("variations")
+            if (isinstance(entry_id, int) and 0 <= entry_id < len(data_points)
+                    and isinstance(variations, list)
+                    and all(isinstance(i, str) for i in variations)):
+                results[entry_id] = variations
+
+        return results
             
     except Exception as e:
         print(f"\nAn API or JSON parsing error occurred: {e}")
+        return None
+
+async def generate_variations(data_point: dict) -> list[str]:
+    """Calls the local LLM API to generate prompt variations for one data point."""
+    results = await request_variations([data_point])
+    if not results or results[0] is None:
         return []
+    return results[0]
+
+async def generate_variations_batch(data_points: list[dict]) -> list[list[str]]:
+    """
+    Generates prompt variations for several data points with a single request.
+    Data points the batched answer is missing are retried one at a time.
+    """
+    results = await request_variations(data_points)
+    if results is None:
+        results = [None] * len(data_points)
+
+    for i, variations in enumerate(results):
+        if variations is None:
+            results[i] = await generate_variations(data_points[i])
+
+    return results
+
+async def warm_up_model() -> None:
+    """Loads the model into memory up front so the first batch doesn't pay for it."""
+    try:
+        await client.chat.completions.create(
+            model=MODEL_TO_USE,
+            messages=[{"role": "user", "content": "ok"}],
+            max_tokens=1,
+            extra_body={"keep_alive": KEEP_ALIVE},
+        )
+    except Exception as e:
+        print(f"\nWarning: Model warm-up failed: {e}")
 
-def main(limit: int):
+def iter_jsonl(path: str, drop_cache: bool = True) -> Iterator[tuple[int, str]]:
+    """
+    Lazily yields (line_number, line) for every non-empty line of a JSONL file.
+    The file is read once front to back, so the kernel is told to read ahead
+    aggressively and, with drop_cache, to evict its pages once finished.
+    """
+    with open(path, 'r') as f_in:
+        fadvise(f_in, 'POSIX_FADV_SEQUENTIAL')
+        try:
+            for line_num, line in enumerate(f_in, 1):
+                line = line.strip()
+                if line:
+                    yield line_num, line
+        finally:
+            if drop_cache:
+                fadvise(f_in, 'POSIX_FADV_DONTNEED')
+
+# Fields every source entry needs; request_variations puts all three in the prompt
+ENTRY_FIELDS = ("instruction", "input", "output")
+
+def iter_entries(lines: Iterable[tuple[int, str]]) -> Iterator[dict]:
+    """
+    Parses JSONL lines, skipping (and reporting) malformed ones and ones that
+    aren't an object with "instruction", "input" and "output", so a single
+    bad row can't sink the batch it lands in.
+    """
+    for line_num, line in lines:
+        try:
+            data_point = json_loads(line)
+        except json.JSONDecodeError:
+            print(f"\nWarning: Skipping malformed JSON line {line_num}: {line}")
+            continue
+        if not isinstance(data_point, dict) or any(k not in data_point for k in ENTRY_FIELDS):
+            print(f"\nWarning: Skipping line {line_num} without instruction/input/output: {line}")
+            continue
+        yield data_point
+
+def iter_batches(entries: Iterable[dict], size: int) -> Iterator[list[dict]]:
+    """Groups entries into lists of at most `size` items."""
+    entries = iter(entries)
+    while batch := list(itertools.islice(entries, size)):
+        yield batch
+
+async def main(limit: int):
     """
     Main function to run the augmentation process.
     """
@@ -112,41 +365,87 @@ def main(limit: int):
     print(f"Source: {SOURCE_FILE}")
     print(f"Destination: {DESTINATION_FILE}")
     print(f"Model: {MODEL_TO_USE}")
+    print(f"Concurrency: {CONCURRENCY}, batch size: {BATCH_SIZE}")
 
+    # A quick counting pass so the progress bar has a total; the entries
+    # themselves are read lazily below. Its pages stay cached for that read.
     try:
-        with open(SOURCE_FILE, 'r') as f_in:
-            lines = f_in.readlines()
+        total = sum(1 for _ in iter_jsonl(SOURCE_FILE, drop_cache=False))
     except FileNotFoundError:
         print(f"Error: Source file not found at {SOURCE_FILE}")
         return
 
-    lines_to_process = lines if limit == -1 else lines[:limit]
-
-    with open(DESTINATION_FILE, 'w') as f_out:
-        for line in tqdm(lines_to_process, desc="Augmenting Dataset"):
-            try:
-                clean_data = json.loads(line)
-                
-                # 1. Write the original, clean data point to the new file
-                f_out.write(json.dumps(clean_data) + '\n')
-                
-                # 2. Generate and write the messy variations
-                variations = generate_variations(clean_data)
-                for messy_input in variations:
-                    augmented_data = {
-                        "instruction": clean_data["instruction"],
-                        "input": messy_input,
-                        "output": clean_data["output"]
-                    }
-                    f_out.write(json.dumps(augmented_data) + '\n')
-                
-                # Be a good citizen to your local server
-                time.sleep(0.5)
-
-            except json.JSONDecodeError:
-                print(f"\nWarning: Skipping malformed JSON line: {line.strip()}")
-                continue
-    
+    source = iter_jsonl(SOURCE_FILE)
+    if limit != -1:
+        source = itertools.islice(source, limit)
+        total = min(total, limit)
+
+    print("Loading model...")
+    await warm_up_model()
+
+    # The semaphore is the only rate control: at most CONCURRENCY requests
+    # are in flight against the local server at any time. It is acquired
+    # before a batch is read, so only CONCURRENCY batches are held in memory.
+    sem = asyncio.Semaphore(CONCURRENCY)
+
+    # Batches finish in arbitrary order; the lock keeps each entry and its
+    # variations together in the output.
+    write_lock = asyncio.Lock()
+
+    with JsonlWriter(DESTINATION_FILE) as writer:
+        # Redraw at most once a second, and not at all when output isn't a
+        # terminal (disable=None), e.g. when logging to a file in CI
+        with tqdm(
+            total=total,
+            desc="Augmenting Dataset",
+            mininterval=1.0,
+            miniters=1,
+            smoothing=0.1,
+            disable=None,
+        ) as progress:
+
+            async def process(batch: list[dict]) -> None:
+                try:
+                    batch_variations = await generate_variations_batch(batch)
+
+                    records = []
+                    for clean_data, variations in zip(batch, batch_variations):
+                        # 1. The original, clean data point
+                        records.append(clean_data)
+
+                        # 2. The messy variations right after it
+                        for messy_input in variations:
+                            records.append({
+                                "instruction": clean_data["instruction"],
+                                "input": messy_input,
+                                "output": clean_data["output"]
+                            })
+
+                    block = await asyncio.to_thread(JsonlWriter.serialize, records)
+                    async with write_lock:
+                        writer.add_serialized(block, len(records))
+                except Exception as e:
+                    print(f"\nWarning: A batch failed to process: {e}")
+                finally:
+                    sem.release()
+                    progress.update(len(batch))
+
+            # Each batch is written as soon as its request completes, so the
+            # output is grouped per entry but in completion order.
+            tasks = set()
+            batches = iter_batches(iter_entries(source), BATCH_SIZE)
+            while True:
+                await sem.acquire()
+                batch = next(batches, None)
+                if batch is None:
+                    sem.release()
+                    break
+                task = asyncio.create_task(process(batch))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            await asyncio.gather(*tasks)
+
     print(f"\nAugmentation complete. Output saved to {DESTINATION_FILE}")
 
 
@@ -160,4 +459,4 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
     
-    main(args.limit)
\ No newline at end of file
+    asyncio.run(main(args.limit))
\ No newline at end of file
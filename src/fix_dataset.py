@@ -5,53 +5,66 @@ Includes enhanced fixing capabilities and validation integration.
 """
 
 import json
+import os
 import re
 import sys
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, TextIO, Tuple
+
+from jsonl_utils import fadvise, json_dumps, json_loads
+
+
+# Patterns applied to every row, compiled once at import
+_RE_EQ = re.compile(r'(\w)\s*=\s*(\w)')
+_RE_CHAIN = re.compile(r'(\)\s*)\.')
+_RE_NUMCOMMA = re.compile(r'(\d+)\s*,\s*(\d+)')
+_RE_DIAM = re.compile(r'(\d+(?:\.\d+)?)\s*mm.*diameter')
+# A continuation line starting with '.' that isn't indented by four spaces
+_RE_BAD_CHAIN_INDENT = re.compile(r'\n(?!    )[^\S\n]*\.')
+
+# Rows read, fixed and written back per batch, so the whole file is never
+# held in memory at once
+FIX_WINDOW_LINES = 1 << 16
 
 
 class DatasetFixer:
     def __init__(self, dataset_path: str):
         self.dataset_path = Path(dataset_path)
         self.backup_path = self.dataset_path.with_suffix('.jsonl.backup')
+        self.tmp_path = self.dataset_path.with_suffix('.jsonl.tmp')
         
-    def fix_common_issues(self, create_backup: bool = True) -> None:
-        """Fix common issues in the dataset with enhanced checks."""
+    def fix_common_issues(self, create_backup: bool = True, workers: int = None) -> None:
+        """
+        Fix common issues in the dataset with enhanced checks.
+        Lines are fixed in parallel across `workers` processes (default: one
+        per CPU); output order always matches input order.
+        """
         
         if create_backup:
             self._create_backup()
         
-        with open(self.dataset_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        fixed_lines = []
         changes_made = 0
         empty_lines_removed = 0
         
-        for line_num, line in enumerate(lines, 1):
-            original_line = line
-            fixed_line = self._fix_line(line.strip())
-            
-            if not fixed_line and original_line.strip():
-                empty_lines_removed += 1
-                print(f"Removed invalid/empty line {line_num}")
-                continue
-            elif not fixed_line:
-                # Skip empty lines
-                continue
-            
-            if fixed_line != original_line.strip():
-                changes_made += 1
-                print(f"Fixed line {line_num}")
-            
-            if fixed_line:  # Only add non-empty lines
-                fixed_lines.append(fixed_line + '\n')
-        
-        # Write fixed dataset
-        with open(self.dataset_path, 'w', encoding='utf-8') as f:
-            f.writelines(fixed_lines)
+        with self._rewrite() as (f_in, f_out):
+            for line_num, original_line, (changed, fixed_line) in self._iter_fixed_lines(f_in, workers):
+                if not fixed_line and original_line:
+                    empty_lines_removed += 1
+                    print(f"Removed invalid/empty line {line_num}")
+                    continue
+                elif not fixed_line:
+                    # Skip empty lines
+                    continue
+                
+                if changed:
+                    changes_made += 1
+                    print(f"Fixed line {line_num}")
+                
+                f_out.write(fixed_line + '\n')
         
         print(f"Dataset fixing complete.")
         print(f"Changes made: {changes_made}")
@@ -59,43 +72,113 @@ class DatasetFixer:
         if create_backup:
             print(f"Original backed up to: {self.backup_path}")
     
+    def _iter_fixed_lines(self, f_in: TextIO, workers: int = None) -> Iterator[Tuple[int, str, Tuple[bool, str]]]:
+        """Yield (line_num, stripped_line, (changed, fixed_line)) for every input line, in order."""
+        workers = workers or os.cpu_count() or 1
+        
+        if workers == 1:
+            for line_num, line in enumerate(f_in, 1):
+                line = line.strip()
+                yield line_num, line, self._fix_line(line)
+            return
+        
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            line_num = 0
+            while True:
+                window = [line.strip() for line in islice(f_in, FIX_WINDOW_LINES)]
+                if not window:
+                    break
+                chunksize = max(1, min(1024, len(window) // (4 * workers)))
+                for line, fixed_line in zip(window, executor.map(self._fix_line, window, chunksize=chunksize)):
+                    line_num += 1
+                    yield line_num, line, fixed_line
+    
+    @contextmanager
+    def _rewrite(self) -> Iterator[Tuple[TextIO, TextIO]]:
+        """
+        Stream the dataset into a temporary file that atomically replaces it
+        on success, so an interrupted run never leaves a half-written dataset.
+        The dataset is read once front to back: ask the kernel for aggressive
+        read-ahead, and to drop its pages afterwards.
+        """
+        try:
+            with open(self.dataset_path, 'r', encoding='utf-8') as f_in, \
+                    open(self.tmp_path, 'w', encoding='utf-8', buffering=1 << 20) as f_out:
+                fadvise(f_in, 'POSIX_FADV_SEQUENTIAL')
+                try:
+                    yield f_in, f_out
+                finally:
+                    fadvise(f_in, 'POSIX_FADV_DONTNEED')
+        except BaseException:
+            self.tmp_path.unlink(missing_ok=True)
+            raise
+        os.replace(self.tmp_path, self.dataset_path)
+    
     def _create_backup(self) -> None:
-        """Create a backup of the original dataset."""
-        shutil.copy2(self.dataset_path, self.backup_path)
+        """
+        Create a backup of the original dataset.
+        The backup is a hard link where possible: fixes never write to the
+        dataset in place (see _rewrite), so the link keeps pointing at the
+        original contents once the fixed file replaces the dataset's name.
+        """
+        self.backup_path.unlink(missing_ok=True)
+        try:
+            os.link(self.dataset_path, self.backup_path)
+        except OSError:
+            # Hard links unsupported (e.g. some filesystems or Windows shares)
+            shutil.copy2(self.dataset_path, self.backup_path)
         print(f"Backup created: {self.backup_path}")
     
-    def _fix_line(self, line: str) -> str:
-        """Fix common issues in a single line."""
+    @staticmethod
+    def _fix_line(line: str) -> Tuple[bool, str]:
+        """
+        Fix common issues in a single line.
+        Returns (changed, fixed_line); fixed_line is "" for lines to drop, and
+        the input line itself when nothing needed fixing.
+        """
         
         if not line:
-            return ""
+            return False, ""
         
         try:
-            data = json.loads(line)
+            data = json_loads(line)
         except json.JSONDecodeError:
             print(f"Skipping invalid JSON line: {line[:50]}...")
-            return ""
+            return True, ""
         
         if not isinstance(data, dict):
-            return ""
+            return True, ""
         
         # Fix missing fields
-        required_fields = {"instruction", "input", "output"}
+        required_fields = ("instruction", "input", "output")
         if not all(field in data for field in required_fields):
-            return ""
+            return True, ""
+        
+        changed = False
         
         # Clean up code formatting
-        if "output" in data:
-            data["output"] = self._fix_code_formatting(data["output"])
+        output = DatasetFixer._fix_code_formatting(data["output"])
+        if output != data["output"]:
+            data["output"] = output
+            changed = True
         
-        # Ensure proper string formatting
-        for field in ["instruction", "input", "output"]:
-            if field in data:
-                data[field] = data[field].strip()
+        # Ensure proper string formatting; strip() only ever removes
+        # characters, so a length check is enough to detect a change
+        for field in required_fields:
+            value = data[field]
+            stripped = value.strip()
+            if len(stripped) != len(value):
+                data[field] = stripped
+                changed = True
         
-        return json.dumps(data, ensure_ascii=False)
+        # Already-clean lines are kept verbatim, skipping re-serialization
+        if not changed:
+            return False, line
+        
+        return True, json_dumps(data)
     
-    def _fix_code_formatting(self, code: str) -> str:
+    @staticmethod
+    def _fix_code_formatting(code: str) -> str:
         """Enhanced code formatting fixes for CadQuery code."""
         
         # Ensure proper import
@@ -103,7 +186,7 @@ class DatasetFixer:
             code = "import cadquery as cq\n\n" + code
         
         # Fix spacing around operators
-        code = re.sub(r'(\w)\s*=\s*(\w)', r'\1 = \2', code)
+        code = _RE_EQ.sub(r'\1 = \2', code)
         
         # Ensure result assignment
         if "result = " not in code and code.strip().startswith("cq."):
@@ -112,62 +195,62 @@ class DatasetFixer:
         # Fix common CadQuery method chaining formatting
         # Ensure proper line breaks for method chaining
         if ".faces(" in code and ".workplane(" in code:
-            code = re.sub(r'(\)\s*)\.', r')\n    .', code)
+            code = _RE_CHAIN.sub(r')\n    .', code)
         
         # Fix common parameter formatting issues
-        code = re.sub(r'(\d+)\s*,\s*(\d+)', r'\1, \2', code)  # Fix spacing in parameters
+        code = _RE_NUMCOMMA.sub(r'\1, \2', code)  # Fix spacing in parameters
         
-        # Ensure proper indentation for multi-line statements
-        lines = code.split('\n')
-        formatted_lines = []
-        for i, line in enumerate(lines):
-            if i > 0 and line.strip().startswith('.') and not line.startswith('    '):
-                formatted_lines.append('    ' + line.strip())
-            else:
-                formatted_lines.append(line)
-        code = '\n'.join(formatted_lines)
+        # Ensure proper indentation for multi-line statements; most code is
+        # already indented, so only split and rejoin when a line needs it
+        if _RE_BAD_CHAIN_INDENT.search(code):
+            code = '\n'.join([
+                '    ' + line.strip()
+                if i > 0 and line.strip().startswith('.') and not line.startswith('    ')
+                else line
+                for i, line in enumerate(code.split('\n'))
+            ])
         
-
+        return code
     
     def fix_specific_issues(self, issue_types: List[str]) -> None:
         """Fix specific types of issues based on validation results."""
         
         print(f"Fixing specific issues: {', '.join(issue_types)}")
         
-        with open(self.dataset_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        fixed_lines = []
         changes_made = 0
         
-        for line_num, line in enumerate(lines, 1):
-            original_line = line.strip()
-            if not original_line:
-                continue
-                
-            try:
-                data = json.loads(original_line)
-                fixed_data = self._fix_specific_data_issues(data, issue_types)
-                
-                fixed_line = json.dumps(fixed_data, ensure_ascii=False)
-                if fixed_line != original_line:
-                    changes_made += 1
-                    print(f"Fixed specific issues on line {line_num}")
-                
-                fixed_lines.append(fixed_line + '\n')
-                
-            except json.JSONDecodeError:
-                # Skip invalid JSON lines
-                continue
-        
-        # Write fixed dataset
-        with open(self.dataset_path, 'w', encoding='utf-8') as f:
-            f.writelines(fixed_lines)
+        with self._rewrite() as (f_in, f_out):
+            for line_num, line in enumerate(f_in, 1):
+                original_line = line.strip()
+                if not original_line:
+                    continue
+                    
+                try:
+                    data = json_loads(original_line)
+                    changed, fixed_data = self._fix_specific_data_issues(data, issue_types)
+                    
+                    # Unchanged lines are written back as they were, keeping
+                    # their original JSON formatting
+                    fixed_line = original_line
+                    if changed:
+                        fixed_line = json_dumps(fixed_data)
+                        changes_made += 1
+                        print(f"Fixed specific issues on line {line_num}")
+                    
+                    f_out.write(fixed_line + '\n')
+                    
+                except json.JSONDecodeError:
+                    # Skip invalid JSON lines
+                    continue
         
         print(f"Specific issue fixing complete. Changes made: {changes_made}")
     
-    def _fix_specific_data_issues(self, data: Dict[str, Any], issue_types: List[str]) -> Dict[str, Any]:
-        """Fix specific data issues based on issue types."""
+    def _fix_specific_data_issues(self, data: Dict[str, Any], issue_types: List[str]) -> Tuple[bool, Dict[str, Any]]:
+        """
+        Fix specific data issues based on issue types.
+        Returns (changed, data) where changed tells whether anything was fixed.
+        """
+        changed = False
         
         if "consistency_warning" in issue_types:
             # Fix diameter/radius consistency issues
@@ -178,7 +261,7 @@ class DatasetFixer:
                 # Look for diameter mentions and ensure radius conversion is clear
                 if "diameter" in input_text:
                     # Add comment to clarify diameter->radius conversion
-                    diameter_match = re.search(r'(\d+(?:\.\d+)?)\s*mm.*diameter', input_text)
+                    diameter_match = _RE_DIAM.search(input_text)
                     if diameter_match:
                         diameter = float(diameter_match.group(1))
                         radius = diameter / 2
@@ -188,7 +271,9 @@ class DatasetFixer:
                                 f"cylinder({radius}",
                                 f"cylinder({radius}  # Diameter {diameter}mm = radius {radius}mm"
                             )
-                            data["output"] = output_code
+                            if output_code != data["output"]:
+                                data["output"] = output_code
+                                changed = True
         
         if "parameter_error" in issue_types:
             # Fix negative or zero parameters
@@ -198,7 +283,7 @@ class DatasetFixer:
                 # For now, just flag for manual review
                 pass
         
-        return data
+        return changed, data
 
     def validate_after_fix(self, enable_dynamic: bool = True) -> None:
         """Run validation after fixing to show results."""
@@ -222,10 +307,16 @@ def main():
     
     dataset_path = "data/dataset.jsonl"
     specific_issues = []
+    workers = None
     
     # Parse command line arguments
     args = sys.argv[1:]
     if args:
+        if '--workers' in args:
+            idx = args.index('--workers')
+            if idx + 1 < len(args):
+                workers = int(args[idx + 1])
+                args = args[:idx] + args[idx + 2:]
         if '--issues' in args:
             idx = args.index('--issues')
             if idx + 1 < len(args):
@@ -253,7 +344,7 @@ def main():
     if specific_issues:
         fixer.fix_specific_issues(specific_issues)
     else:
-        fixer.fix_common_issues()
+        fixer.fix_common_issues(workers=workers)
     
     fixer.validate_after_fix()
 
@@ -0,0 +1,55 @@
+"""
+JSONL read/write helpers shared by the dataset scripts.
+"""
+
+import json
+import os
+from typing import Any
+
+# orjson is several times faster than the stdlib json module for the
+# per-line parse/serialize work; fall back to json when it isn't installed.
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+if ORJSON_AVAILABLE:
+    def json_loads(data: Any) -> Any:
+        """
+        Parse with orjson, retrying with json for input only json accepts
+        (NaN/Infinity, lone surrogate escapes), so both backends agree on
+        which lines are valid.
+        """
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+    def json_dumps(obj: Any) -> str:
+        """Serialize to a compact, non-ASCII-escaped JSON string."""
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # Values orjson can't encode, e.g. integers wider than 64 bits or
+            # lone surrogates; the latter can't be written as UTF-8 either,
+            # so they must stay escaped
+            return json.dumps(obj, separators=(',', ':'))
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj: Any) -> str:
+        """Serialize to a compact, non-ASCII-escaped JSON string."""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def fadvise(f, advice: str) -> None:
+    """
+    Best-effort page-cache hint (e.g. "POSIX_FADV_SEQUENTIAL") covering the
+    whole file; a no-op on platforms without posix_fadvise.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            pass
@@ -42,7 +42,7 @@ def main():
         if cadquery_available:
             print("\nTesting dynamic validation:")
             validator_dynamic = DatasetValidator("data/dataset.jsonl", enable_dynamic_validation=True)
-            is_valid, errors, warnings = validator_dynamic.validate()
+            is_valid, errors, warnings = validator_dynamic.validate_dynamic_only(validator_static)
             validator_dynamic.print_report()
         else:
             print("\nSkipping dynamic validation (CadQuery not available)")
@@ -4,36 +4,233 @@ Dataset validation script for CadQuery training data.
 Validates JSONL format, content quality, CadQuery code syntax, and dynamic execution.
 """
 
-import json
 import ast
+import hashlib
+import importlib.util
+import io
 import re
 import sys
 import tempfile
 import os
-from typing import Dict, List, Tuple, Any
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from types import CodeType
+from typing import Dict, List, Tuple, Any, Iterator, Optional, Union
 from pathlib import Path
 
-# Import CadQuery for dynamic validation
+from jsonl_utils import json_loads
+
+# jiter parses JSON straight from bytes, several times faster than the json
+# module, and caches the repeated "instruction"/"input"/"output" keys.
+# Without it, json_loads (orjson if installed, else json) takes the bytes.
+try:
+    import jiter
+    JITER_AVAILABLE = True
+except ImportError:
+    JITER_AVAILABLE = False
+
+if JITER_AVAILABLE:
+    def _parse_json(line: bytes) -> Any:
+        return jiter.from_json(line, cache_mode="keys")
+else:
+    _parse_json = json_loads
+
+# CadQuery is needed for dynamic validation only, and is slow to import, so
+# it is imported on first use (in each worker process that needs it)
+CADQUERY_AVAILABLE = importlib.util.find_spec("cadquery") is not None
+cq = None
+
+
+def _import_cadquery() -> bool:
+    """Import CadQuery if not done yet; returns whether it is usable."""
+    global cq, CADQUERY_AVAILABLE
+    if cq is None and CADQUERY_AVAILABLE:
+        try:
+            import cadquery
+        except ImportError:  # Installed but broken, e.g. a missing OCP library
+            CADQUERY_AVAILABLE = False
+        else:
+            cq = cadquery
+    return cq is not None
+
+
+# Patterns used on every line, compiled once at import
+_WORKPLANE_RE = re.compile(r'cq\.Workplane\(["\'](?:XY|YZ|ZX|XZ|YX|ZY)["\']')
+_DIM_RE = re.compile(r'(\d+(?:\.\d+)?)\s*mm')
+_NUM_RE = re.compile(r'-?\d+(?:\.\d+)?')
+_UNSIGNED_NUM_RE = re.compile(r'(\d+(?:\.\d+)?)')
+
+# Functions whose numeric arguments are checked (see _PARAMETER_CHECKS); one
+# pattern finds the start of a call to any of them, capturing the function
+# name. Functions without a check are left out so that the scan skips their
+# calls instead of extracting them for nothing. A call's argument list runs
+# from its "(" to the next ")"; only call starts are matched, so calls nested
+# in another call's arguments are found too. A call starting inside the
+# argument list of a call to the same function is skipped, as those
+# arguments have already been checked.
+NUMERIC_FUNCTIONS = [
+    'box', 'cylinder', 'sphere', 'hole', 'fillet', 'chamfer'
+]
+# ASCII-only, like Hyperscan's \b and \s, so both backends find the same calls
+_CALL_RE = re.compile(rf'\b({"|".join(NUMERIC_FUNCTIONS)})\s*\(', re.ASCII)
+
+# Hyperscan compiles the code patterns into one database and matches them
+# all in a single pass over the code, instead of one re scan per pattern
 try:
-    import cadquery as cq
-    CADQUERY_AVAILABLE = True
+    import hyperscan
+    HYPERSCAN_AVAILABLE = True
 except ImportError:
-    CADQUERY_AVAILABLE = False
+    HYPERSCAN_AVAILABLE = False
+
+_SCAN_WORKPLANE, _SCAN_FUNC_CALL = 0, 1
+
+if HYPERSCAN_AVAILABLE:
+    _SCAN_DB = hyperscan.Database()
+    _SCAN_DB.compile(
+        expressions=[_WORKPLANE_RE.pattern.encode(), _CALL_RE.pattern.encode()],
+        ids=[_SCAN_WORKPLANE, _SCAN_FUNC_CALL],
+        elements=2,
+        # Call matches need their start offset to slice the function name out
+        flags=[hyperscan.HS_FLAG_SINGLEMATCH, hyperscan.HS_FLAG_SOM_LEFTMOST],
+    )
+
+    def _scan_code(code: str) -> Tuple[bool, List[Tuple[str, str]]]:
+        """Return (has Workplane pattern, [(function, argument list), ...]) for code."""
+        data = code.encode()
+        found_workplane = False
+        spans = []
+
+        def on_match(pattern_id, start, end, flags, context):
+            nonlocal found_workplane
+            if pattern_id == _SCAN_WORKPLANE:
+                found_workplane = True
+            else:
+                spans.append((start, end))
+
+        _SCAN_DB.scan(data, match_event_handler=on_match)
+
+        calls = []
+        args_ends = {}
+        for start, end in spans:
+            # The span is "func (" ; function names never contain "("
+            name = data[start:end - 1].rstrip().decode()
+            if start < args_ends.get(name, -1):
+                continue
+            args_end = data.find(b")", end)
+            if args_end == -1:
+                continue
+            args_ends[name] = args_end
+            calls.append((name, data[end:args_end].decode()))
+        return found_workplane, calls
+else:
+    def _scan_code(code: str) -> Tuple[bool, List[Tuple[str, str]]]:
+        """Return (has Workplane pattern, [(function, argument list), ...]) for code."""
+        found_workplane = _WORKPLANE_RE.search(code) is not None
+        calls = []
+        args_ends = {}
+        for match in _CALL_RE.finditer(code):
+            name = match.group(1)
+            if match.start() < args_ends.get(name, -1):
+                continue
+            args_end = code.find(")", match.end())
+            if args_end != -1:
+                args_ends[name] = args_end
+                calls.append((name, code[match.end():args_end]))
+        return found_workplane, calls
+
+
+# Parameter checks: each takes (function name, value) and returns
+# (severity, type, message) for a problem, or None
+def _check_dimension(func: str, num: float) -> Optional[Tuple[str, str, str]]:
+    if num <= 0:
+        return ("error", "parameter_error", f"Dimension parameter {num} should be positive in {func}()")
+    if num > 1000:
+        return ("warning", "parameter_warning", f"Large dimension parameter {num} in {func}() - verify units")
+    return None
+
+
+def _check_edge_radius(func: str, num: float) -> Optional[Tuple[str, str, str]]:
+    if num <= 0:
+        return ("error", "parameter_error", f"Fillet/chamfer radius {num} must be positive")
+    return None
+
+
+def _check_hole_diameter(func: str, num: float) -> Optional[Tuple[str, str, str]]:
+    if num <= 0:
+        return ("error", "parameter_error", f"Hole diameter {num} must be positive")
+    return None
+
+
+_PARAMETER_CHECKS = {
+    'box': _check_dimension,
+    'cylinder': _check_dimension,
+    'sphere': _check_dimension,
+    'fillet': _check_edge_radius,
+    'chamfer': _check_edge_radius,
+    'hole': _check_hole_diameter,
+}
+
+# Fields every dataset line must have, in report order
+REQUIRED_FIELDS = ("instruction", "input", "output")
+_REQUIRED_FIELD_SET = frozenset(REQUIRED_FIELDS)
+
+# Upper bound on lines (static pass) or distinct snippets (dynamic pass)
+# queued on the worker pool at once
+VALIDATION_WINDOW_LINES = 1 << 14
+
+# Distinct output snippets whose validation results are remembered, so that
+# duplicated outputs are not compiled, executed and exported again
+CODE_CACHE_SIZE = 1 << 16
+
+# Input keywords that imply the output should call the matching shape method
+SHAPE_KEYWORDS = {
+    'box': ('box', 'cube', 'rectangular', 'square', 'plate'),
+    'cylinder': ('cylinder', 'rod', 'pipe', 'circular'),
+    'sphere': ('sphere', 'ball'),
+    'wedge': ('wedge', 'triangular')
+}
+_SHAPE_TOKENS = {shape: f'.{shape}(' for shape in SHAPE_KEYWORDS}
+
+# Where STL exports go when CadQuery cannot export to memory: tmpfs if
+# there is one, else the default temporary directory
+_STL_SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Shape types accepted as a finished part by the dynamic geometry check
+_SOLID_SHAPE_TYPES = ("Solid", "CompSolid", "Compound")
 
 
 class DatasetValidator:
-    def __init__(self, dataset_path: str, enable_dynamic_validation: bool = True):
+    def __init__(self, dataset_path: str, enable_dynamic_validation: bool = True, workers: Optional[int] = None,
+                 full_export_check: bool = False):
         self.dataset_path = Path(dataset_path)
         self.enable_dynamic_validation = enable_dynamic_validation and CADQUERY_AVAILABLE
+        # Dynamic validation checks the result's B-rep directly; exporting
+        # every result to STL as well is much slower (it tessellates)
+        self.full_export_check = full_export_check
+        # Dynamic validation runs across this many processes, using every CPU
+        # by default. Static checks run in-process, as they are cheaper than
+        # shipping lines to other processes, unless they are all there is to
+        # do and more workers are asked for.
+        if workers is None:
+            workers = (os.cpu_count() or 1) if self.enable_dynamic_validation else 1
+        self.workers = workers
         self.errors: List[Dict[str, Any]] = []
         self.warnings: List[Dict[str, Any]] = []
-        self.temp_dir = tempfile.mkdtemp(prefix="cadbot_validation_") if self.enable_dynamic_validation else None
-        
-    def __del__(self):
-        """Clean up temporary files."""
-        import shutil
-        if hasattr(self, 'temp_dir') and self.temp_dir and os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir, ignore_errors=True)
+        # (line_num, code) for every output that passed static validation
+        self.static_valid_code: List[Tuple[int, str]] = []
+        # Non-empty lines seen by validate(), for the report
+        self._nonempty_count = 0
+        # Output code hash -> (errors, warnings, passed) of its static
+        # validation, in least recently used order
+        self._code_cache: Dict[bytes, Tuple[List[Dict], List[Dict], bool]] = {}
+        # Output code -> its compiled code object, kept from the static pass
+        # for dynamic validation when that runs in this process
+        self._compiled_code: Dict[str, CodeType] = {}
+        # Globals shared by every exec() of output code, built on first use
+        # (once CadQuery is imported); code runs with its own fresh locals
+        self._exec_globals: Optional[Dict[str, Any]] = None
+        # Whether cq.exporters.export() accepts a file-like object here
+        self._stl_to_buffer = True
         
     def validate(self) -> Tuple[bool, List[Dict], List[Dict]]:
         """
@@ -56,33 +253,168 @@ class DatasetValidator:
             })
             return False, self.errors, self.warnings
         
-        with open(self.dataset_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        # Pass 1: cheap checks on every line, collecting the outputs that
+        # pass static validation
+        if self.workers == 1 or self.enable_dynamic_validation:
+            for line_num, line, is_last in self._iter_lines():
+                self._validate_line(line_num, line, self.errors, self.warnings, is_last)
+        else:
+            self._validate_parallel()
+        
+        # Pass 2: execute those outputs
+        if self.enable_dynamic_validation:
+            self._validate_dynamic()
+        
+        is_valid = len(self.errors) == 0
+        return is_valid, self.errors, self.warnings
+    
+    def _iter_lines(self) -> Iterator[Tuple[int, bytes, bool]]:
+        """
+        Stream (line_num, stripped_line, is_last) for every line of the dataset.
+        Lines are raw bytes (the JSON parser decodes UTF-8 itself); one line is
+        held back so the last line can be recognised.
+        """
+        with open(self.dataset_path, 'rb') as f:
+            prev_line = None
+            line_num = 0
+            for line_num, line in enumerate(f, 1):
+                if prev_line is not None:
+                    yield line_num - 1, prev_line.strip(), False
+                prev_line = line
+            if prev_line is not None:
+                yield line_num, prev_line.strip(), True
+    
+    def _validate_parallel(self) -> None:
+        """Statically validate lines across a process pool, merging results in line order."""
+        lines = self._iter_lines()
+        with self._worker_pool() as executor:
+            while True:
+                window = list(islice(lines, VALIDATION_WINDOW_LINES))
+                if not window:
+                    break
+                chunksize = max(1, min(64, len(window) // (4 * self.workers)))
+                for errors, warnings, static_valid_code, nonempty in executor.map(
+                    _validate_line_worker, window, chunksize=chunksize
+                ):
+                    self.errors.extend(errors)
+                    self.warnings.extend(warnings)
+                    self.static_valid_code.extend(static_valid_code)
+                    self._nonempty_count += nonempty
+    
+    def _worker_pool(self) -> ProcessPoolExecutor:
+        """Start a process pool whose workers each hold a validator like this one."""
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_validation_worker,
+            initargs=(str(self.dataset_path), self.full_export_check),
+        )
+    
+    def _validate_dynamic(self) -> None:
+        """
+        Dynamically validate every output in static_valid_code, across a
+        process pool unless workers is 1. Identical outputs are executed once
+        and their results reported on each of their lines.
+        """
+        # Distinct code -> lines it appears on, in order of first appearance
+        lines_by_code: Dict[str, List[int]] = {}
+        for line_num, code in self.static_valid_code:
+            lines_by_code.setdefault(code, []).append(line_num)
+        if not lines_by_code:
+            return
         
-        for line_num, line in enumerate(lines, 1):
-            self._validate_line(line_num, line.strip())
+        # Import here, so a broken installation falls back to the static
+        # results rather than failing every output
+        if not _import_cadquery():
+            self.enable_dynamic_validation = False
+            self._compiled_code.clear()
+            print("CadQuery not available. Install with: pip install cadquery>=2.4.0")
+            return
+        
+        jobs = [(line_nums[0], code) for code, line_nums in lines_by_code.items()]
+        if self.workers == 1:
+            # Execute the code objects compiled by the static pass, if any
+            results = (
+                self._validate_dynamic_one((line_num, self._compiled_code.pop(code, code)))
+                for line_num, code in jobs
+            )
+            self._merge_dynamic_results(lines_by_code, results)
+        else:
+            with self._worker_pool() as executor:
+                for start in range(0, len(jobs), VALIDATION_WINDOW_LINES):
+                    window = jobs[start:start + VALIDATION_WINDOW_LINES]
+                    chunksize = max(1, min(16, len(window) // (4 * self.workers)))
+                    self._merge_dynamic_results(
+                        {code: lines_by_code[code] for _, code in window},
+                        executor.map(_dyn_worker, window, chunksize=chunksize),
+                    )
+        
+        # Report in line order, as a single combined pass would
+        self.errors.sort(key=lambda error: error["line"])
+        self.warnings.sort(key=lambda warning: warning["line"])
+    
+    def _validate_dynamic_one(self, job: Tuple[int, Union[str, CodeType]]) -> Tuple[List[Dict], List[Dict]]:
+        """Dynamically validate one (line_num, code) job; returns its errors and warnings."""
+        line_num, code = job
+        errors: List[Dict] = []
+        warnings: List[Dict] = []
+        self._validate_cadquery_code_dynamic(line_num, code, errors, warnings)
+        return errors, warnings
+    
+    def _merge_dynamic_results(self, lines_by_code: Dict[str, List[int]],
+                               results: Iterator[Tuple[List[Dict], List[Dict]]]) -> None:
+        """Add each output's dynamic results, in job order, to every line it appears on."""
+        for line_nums, (errors, warnings) in zip(lines_by_code.values(), results):
+            for line_num in line_nums:
+                self.errors.extend({**error, "line": line_num} for error in errors)
+                self.warnings.extend({**warning, "line": line_num} for warning in warnings)
+    
+    def validate_dynamic_only(self, static_validator: "DatasetValidator") -> Tuple[bool, List[Dict], List[Dict]]:
+        """
+        Run only the dynamic execution checks, reusing the results of a
+        completed static-only validate() on the same dataset instead of
+        parsing and checking every line again.
+        Returns: (is_valid, errors, warnings) covering both passes
+        """
+        print(f"Validating dataset: {self.dataset_path}")
+        print("Dynamic execution validation: ENABLED (reusing static results)")
+        
+        self.errors = list(static_validator.errors)
+        self.warnings = list(static_validator.warnings)
+        self.static_valid_code = static_validator.static_valid_code
+        self._nonempty_count = static_validator._nonempty_count
+        
+        if self.enable_dynamic_validation:
+            self._validate_dynamic()
         
         is_valid = len(self.errors) == 0
         return is_valid, self.errors, self.warnings
     
-    def _validate_line(self, line_num: int, line: str) -> None:
-        """Validate a single line of the dataset."""
+    def _validate_line(self, line_num: int, line: bytes, errors: List[Dict], warnings: List[Dict],
+                       is_last: bool = False) -> None:
+        """
+        Validate a single line of the dataset.
+        Problems found are appended to the errors and warnings lists passed
+        in, as are those of every check below; a caller can pass its report
+        lists, or fresh lists to collect one line's results.
+        """
         
         # Skip empty lines
-        if not line.strip():
-            if line_num != len(open(self.dataset_path).readlines()):  # Allow empty last line
-                self.warnings.append({
+        if not line:
+            if not is_last:  # Allow empty last line
+                warnings.append({
                     "line": line_num,
                     "type": "empty_line",
                     "message": "Empty line found"
                 })
             return
         
+        self._nonempty_count += 1
+        
         # 1. JSON Structure Validation
         try:
-            data = json.loads(line)
-        except json.JSONDecodeError as e:
-            self.errors.append({
+            data = _parse_json(line)
+        except ValueError as e:  # JSONDecodeError, jiter errors, bad UTF-8
+            errors.append({
                 "line": line_num,
                 "type": "json_error",
                 "message": f"Invalid JSON: {str(e)}"
@@ -90,17 +422,17 @@ class DatasetValidator:
             return
         
         # 2. Schema Validation
-        self._validate_schema(line_num, data)
+        self._validate_schema(line_num, data, errors, warnings)
         
         # 3. Content Validation
         if isinstance(data, dict):
-            self._validate_content(line_num, data)
+            self._validate_content(line_num, data, errors, warnings)
     
-    def _validate_schema(self, line_num: int, data: Any) -> None:
+    def _validate_schema(self, line_num: int, data: Any, errors: List[Dict], warnings: List[Dict]) -> None:
         """Validate the JSON schema structure."""
         
         if not isinstance(data, dict):
-            self.errors.append({
+            errors.append({
                 "line": line_num,
                 "type": "schema_error",
                 "message": "Line must be a JSON object"
@@ -108,48 +440,48 @@ class DatasetValidator:
             return
         
         # Required fields
-        required_fields = {"instruction", "input", "output"}
-        missing_fields = required_fields - set(data.keys())
+        missing_fields = [field for field in REQUIRED_FIELDS if field not in data]
         
         if missing_fields:
-            self.errors.append({
+            errors.append({
                 "line": line_num,
                 "type": "schema_error",
                 "message": f"Missing required fields: {', '.join(missing_fields)}"
             })
         
-        # Check for unexpected fields
-        unexpected_fields = set(data.keys()) - required_fields
-        if unexpected_fields:
-            self.warnings.append({
+        # Check for unexpected fields; only needed when there are more keys
+        # than the required fields present
+        if len(data) > len(REQUIRED_FIELDS) - len(missing_fields):
+            unexpected_fields = [field for field in data if field not in _REQUIRED_FIELD_SET]
+            warnings.append({
                 "line": line_num,
                 "type": "schema_warning",
                 "message": f"Unexpected fields found: {', '.join(unexpected_fields)}"
             })
         
         # Validate field types
-        for field in required_fields:
+        for field in REQUIRED_FIELDS:
             if field in data and not isinstance(data[field], str):
-                self.errors.append({
+                errors.append({
                     "line": line_num,
                     "type": "schema_error",
                     "message": f"Field '{field}' must be a string, got {type(data[field]).__name__}"
                 })
     
-    def _validate_content(self, line_num: int, data: Dict[str, str]) -> None:
+    def _validate_content(self, line_num: int, data: Dict[str, str], errors: List[Dict], warnings: List[Dict]) -> None:
         """Validate the content quality and consistency."""
         
         # Check for empty fields
-        for field in ["instruction", "input", "output"]:
+        for field in REQUIRED_FIELDS:
             if field in data:
                 if not data[field].strip():
-                    self.errors.append({
+                    errors.append({
                         "line": line_num,
                         "type": "content_error",
                         "message": f"Field '{field}' cannot be empty"
                     })
                 elif len(data[field].strip()) < 5:
-                    self.warnings.append({
+                    warnings.append({
                         "line": line_num,
                         "type": "content_warning",
                         "message": f"Field '{field}' seems very short (< 5 characters)"
@@ -157,35 +489,71 @@ class DatasetValidator:
         
         # Validate output code if present
         if "output" in data and data["output"].strip():
-            # Static validation first (fast)
-            static_valid = self._validate_cadquery_code_static(line_num, data["output"])
-            
-            # Dynamic validation only if static passes (slower but thorough)
-            if static_valid and self.enable_dynamic_validation:
-                self._validate_cadquery_code_dynamic(line_num, data["output"])
+            self._validate_output_code(line_num, data["output"], errors, warnings)
         
         # Validate instruction-input-output consistency
-        if all(field in data for field in ["instruction", "input", "output"]):
-            self._validate_consistency(line_num, data)
+        if all(field in data for field in REQUIRED_FIELDS):
+            self._validate_consistency(line_num, data, errors, warnings)
+    
+    def _validate_output_code(self, line_num: int, code: str, errors: List[Dict], warnings: List[Dict]) -> None:
+        """
+        Statically validate an output, replaying the cached results when the
+        same code has already been validated.
+        """
+        key = hashlib.blake2b(code.encode(), digest_size=16).digest()
+        cached = self._code_cache.pop(key, None)
+        
+        if cached is None:
+            errors_start = len(errors)
+            warnings_start = len(warnings)
+            
+            code_obj = self._validate_cadquery_code_static(line_num, code, errors, warnings)
+            cached = (errors[errors_start:], warnings[warnings_start:], code_obj is not None)
+            # Code objects cannot be sent to worker processes, so they are
+            # only worth keeping when the dynamic pass runs in-process
+            if isinstance(code_obj, CodeType) and self.enable_dynamic_validation and self.workers == 1:
+                self._compiled_code[code] = code_obj
+            if len(self._code_cache) >= CODE_CACHE_SIZE:
+                del self._code_cache[next(iter(self._code_cache))]
+        else:
+            cached_errors, cached_warnings, _ = cached
+            errors.extend({**error, "line": line_num} for error in cached_errors)
+            warnings.extend({**warning, "line": line_num} for warning in cached_warnings)
+        
+        self._code_cache[key] = cached
+        if cached[2]:
+            self.static_valid_code.append((line_num, code))
     
-    def _validate_cadquery_code_static(self, line_num: int, code: str) -> bool:
-        """Static validation of CadQuery code syntax and structure."""
-        initial_error_count = len(self.errors)
+    def _validate_cadquery_code_static(self, line_num: int, code: str,
+                                       errors: List[Dict], warnings: List[Dict]) -> Union[str, CodeType, None]:
+        """
+        Static validation of CadQuery code syntax and structure.
+        Returns the compiled code if it passed, ready for exec(), else None.
+        Code that parses but that the compiler rejects passes as its source.
+        """
+        initial_error_count = len(errors)
         
         # 1. Python syntax validation
         try:
-            ast.parse(code)
-        except SyntaxError as e:
-            self.errors.append({
-                "line": line_num,
-                "type": "syntax_error",
-                "message": f"Python syntax error: {str(e)}"
-            })
-            return
+            code_obj = compile(code, "<unknown>", "exec")
+        except SyntaxError:
+            # Only parser errors count as syntax errors. Compiler-stage ones
+            # ('return' outside function, ...) are left for execution to
+            # report as runtime errors.
+            try:
+                ast.parse(code)
+            except SyntaxError as e:
+                errors.append({
+                    "line": line_num,
+                    "type": "syntax_error",
+                    "message": f"Python syntax error: {str(e)}"
+                })
+                return None
+            code_obj = code
         
         # 2. Required import validation
         if "import cadquery as cq" not in code:
-            self.errors.append({
+            errors.append({
                 "line": line_num,
                 "type": "import_error",
                 "message": "Missing required import: 'import cadquery as cq'"
@@ -193,40 +561,50 @@ class DatasetValidator:
         
         # 3. Result variable validation
         if "result = " not in code:
-            self.errors.append({
+            errors.append({
                 "line": line_num,
                 "type": "structure_error",
                 "message": "Missing 'result = ' assignment"
             })
         
         # 4. CadQuery pattern validation
-        if not re.search(r'cq\.Workplane\(["\']X[YZ]["\']|["\'][YZ]X["\']|["\'][YZ][XZ]["\']\)', code):
-            self.warnings.append({
+        found_workplane, calls = _scan_code(code)
+        if not found_workplane:
+            warnings.append({
                 "line": line_num,
                 "type": "pattern_warning",
                 "message": "No standard CadQuery Workplane pattern found"
             })
         
         # 5. Validate numeric parameters
-        self._validate_numeric_parameters(line_num, code)
+        self._validate_numeric_parameters(line_num, calls, errors, warnings)
         
-        return len(self.errors) == initial_error_count
+        return code_obj if len(errors) == initial_error_count else None
     
-    def _validate_cadquery_code_dynamic(self, line_num: int, code: str) -> None:
+    def _validate_cadquery_code_dynamic(self, line_num: int, code: Union[str, CodeType],
+                                        errors: List[Dict], warnings: List[Dict]) -> None:
         """Dynamic execution validation - actually runs CadQuery code to verify geometry."""
         
+        if self._exec_globals is None:
+            if not _import_cadquery():
+                errors.append({
+                    "line": line_num,
+                    "type": "runtime_error",
+                    "message": "Code execution failed: CadQuery could not be imported"
+                })
+                return
+            self._exec_globals = {'cq': cq}
+        
         try:
-            # Create isolated execution environment
+            # Execute the code; its names are bound in a fresh local scope,
+            # so the shared globals stay untouched
             local_scope = {}
-            global_scope = {'cq': cq}
-            
-            # Execute the code
-            exec(code, global_scope, local_scope)
+            exec(code, self._exec_globals, local_scope)
             
             # Check if result was created
             result_obj = local_scope.get('result')
             if result_obj is None:
-                self.errors.append({
+                errors.append({
                     "line": line_num,
                     "type": "execution_error",
                     "message": "Code executed but 'result' variable was not created"
@@ -235,113 +613,128 @@ class DatasetValidator:
             
             # Validate result type
             if not isinstance(result_obj, (cq.Workplane, cq.Shape)):
-                self.errors.append({
+                errors.append({
                     "line": line_num,
                     "type": "execution_error",
                     "message": f"Result is not a valid CadQuery object, got {type(result_obj).__name__}"
                 })
                 return
             
-            # Try to export to STL - the ultimate validation test
-            temp_stl_path = os.path.join(self.temp_dir, f"test_line_{line_num}.stl")
-            
-            try:
-                cq.exporters.export(result_obj, temp_stl_path)
-                
-                # Verify the exported file exists and has reasonable size
-                if os.path.exists(temp_stl_path):
-                    file_size = os.path.getsize(temp_stl_path)
-                    if file_size < 100:  # STL files should be at least 100 bytes
-                        self.warnings.append({
-                            "line": line_num,
-                            "type": "geometry_warning",
-                            "message": f"Generated STL is very small ({file_size} bytes) - may be degenerate geometry"
-                        })
-                    
-                    # Clean up the test file
-                    os.remove(temp_stl_path)
-                else:
-                    self.errors.append({
-                        "line": line_num,
-                        "type": "export_error",
-                        "message": "STL export completed but file was not created"
-                    })
-                    
-            except Exception as export_error:
-                self.errors.append({
-                    "line": line_num,
-                    "type": "geometry_error",
-                    "message": f"Geometry export failed: {str(export_error)}"
-                })
+            # Check the geometry itself, or export it to STL if asked to
+            if self.full_export_check:
+                self._validate_stl_export(line_num, result_obj, errors, warnings)
+            else:
+                self._validate_geometry(line_num, result_obj, errors, warnings)
                 
         except Exception as e:
-            self.errors.append({
+            errors.append({
                 "line": line_num,
                 "type": "runtime_error",
                 "message": f"Code execution failed: {str(e)}"
             })
     
-    def _validate_numeric_parameters(self, line_num: int, code: str) -> None:
-        """Validate that numeric parameters in CadQuery code are reasonable."""
-        
-        # Find function calls with numeric parameters
-        numeric_functions = [
-            'box', 'cylinder', 'sphere', 'hole', 'fillet', 'chamfer',
-            'translate', 'rotate', 'rarray', 'polarArray', 'cboreHole'
-        ]
-        
-        for func in numeric_functions:
-            # Look for function calls
-            pattern = rf'{func}\s*\([^)]*\)'
-            matches = re.finditer(pattern, code)
+    def _validate_geometry(self, line_num: int, result_obj: Any, errors: List[Dict], warnings: List[Dict]) -> None:
+        """Check that every shape in the result is a valid solid, without tessellating it."""
+        try:
+            objects = result_obj.vals() if isinstance(result_obj, cq.Workplane) else [result_obj]
+            shapes = [obj for obj in objects if isinstance(obj, cq.Shape) and not obj.isNull()]
+            if not shapes:
+                errors.append({
+                    "line": line_num,
+                    "type": "geometry_error",
+                    "message": "Result does not contain any geometry"
+                })
+                return
             
-            for match in matches:
-                func_call = match.group()
-                # Extract numeric values
-                numbers = re.findall(r'-?\d+(?:\.\d+)?', func_call)
-                
-                for num_str in numbers:
-                    try:
-                        num = float(num_str)
-                        # Enhanced parameter validation
-                        if func in ['box', 'cylinder', 'sphere'] and num <= 0:
-                            self.errors.append({
-                                "line": line_num,
-                                "type": "parameter_error",
-                                "message": f"Dimension parameter {num} should be positive in {func}()"
-                            })
-                        elif func in ['box', 'cylinder', 'sphere'] and num > 1000:
-                            self.warnings.append({
-                                "line": line_num,
-                                "type": "parameter_warning",
-                                "message": f"Large dimension parameter {num} in {func}() - verify units"
-                            })
-                        elif func in ['fillet', 'chamfer'] and num <= 0:
-                            self.errors.append({
-                                "line": line_num,
-                                "type": "parameter_error",
-                                "message": f"Fillet/chamfer radius {num} must be positive"
-                            })
-                        elif func in ['hole'] and num <= 0:
-                            self.errors.append({
-                                "line": line_num,
-                                "type": "parameter_error",
-                                "message": f"Hole diameter {num} must be positive"
-                            })
-                    except ValueError:
-                        continue
+            for i, shape in enumerate(shapes):
+                # Name the shape only when the result holds several
+                where = f" (shape {i + 1} of {len(shapes)})" if len(shapes) > 1 else ""
+                if shape.ShapeType() not in _SOLID_SHAPE_TYPES:
+                    warnings.append({
+                        "line": line_num,
+                        "type": "geometry_warning",
+                        "message": f"Result{where} is a {shape.ShapeType()}, not a solid - may be degenerate geometry"
+                    })
+                elif not shape.isValid():
+                    errors.append({
+                        "line": line_num,
+                        "type": "geometry_error",
+                        "message": f"Result geometry{where} is not valid (B-rep check failed)"
+                    })
+        except Exception as e:
+            errors.append({
+                "line": line_num,
+                "type": "geometry_error",
+                "message": f"Geometry check failed: {str(e)}"
+            })
     
-    def _validate_consistency(self, line_num: int, data: Dict[str, str]) -> None:
+    def _validate_stl_export(self, line_num: int, result_obj: Any, errors: List[Dict], warnings: List[Dict]) -> None:
+        """Export the result to STL - the ultimate validation test."""
+        try:
+            stl_size = self._export_stl(result_obj)
+        except Exception as export_error:
+            errors.append({
+                "line": line_num,
+                "type": "geometry_error",
+                "message": f"Geometry export failed: {str(export_error)}"
+            })
+            return
+        
+        if stl_size < 100:  # STL files should be at least 100 bytes
+            warnings.append({
+                "line": line_num,
+                "type": "geometry_warning",
+                "message": f"Generated STL is very small ({stl_size} bytes) - may be degenerate geometry"
+            })
+    
+    def _export_stl(self, result_obj: Any) -> int:
+        """Export the result to STL in memory; returns the size of the STL in bytes."""
+        if self._stl_to_buffer:
+            buffer = io.BytesIO()
+            try:
+                cq.exporters.export(result_obj, buffer, exportType="STL")
+                return buffer.tell()
+            except (TypeError, AttributeError):
+                # This CadQuery only exports to paths; use a file in tmpfs
+                self._stl_to_buffer = False
+        
+        fd, stl_path = tempfile.mkstemp(suffix=".stl", dir=_STL_SCRATCH_DIR)
+        os.close(fd)
+        try:
+            cq.exporters.export(result_obj, stl_path)
+            return os.path.getsize(stl_path)
+        finally:
+            os.remove(stl_path)
+    
+    def _validate_numeric_parameters(self, line_num: int, calls: List[Tuple[str, str]],
+                                     errors: List[Dict], warnings: List[Dict]) -> None:
+        """Validate that numeric parameters in CadQuery code are reasonable.
+
+        calls holds (function, argument list) pairs found by _scan_code().
+        """
+        for func, func_args in calls:
+            check = _PARAMETER_CHECKS[func]
+            for num_str in _NUM_RE.findall(func_args):
+                issue = check(func, float(num_str))
+                if issue is None:
+                    continue
+                severity, issue_type, message = issue
+                (errors if severity == "error" else warnings).append({
+                    "line": line_num,
+                    "type": issue_type,
+                    "message": message
+                })
+    
+    def _validate_consistency(self, line_num: int, data: Dict[str, str],
+                              errors: List[Dict], warnings: List[Dict]) -> None:
         """Validate consistency between instruction, input, and output."""
         
-        instruction = data["instruction"].lower()
         input_text = data["input"].lower()
         output = data["output"].lower()
         
         # Enhanced dimension validation with diameter/radius conversion
-        dimension_pattern = r'(\d+(?:\.\d+)?)\s*mm'
-        input_dimensions = re.findall(dimension_pattern, input_text)
-        output_dimensions = re.findall(r'(\d+(?:\.\d+)?)', output)
+        input_dimensions = _DIM_RE.findall(input_text)
+        output_dimensions = set(_UNSIGNED_NUM_RE.findall(output))
         
         # Check for diameter/radius conversions
         for dim in input_dimensions:
@@ -354,28 +747,16 @@ class DatasetValidator:
                     # This is correct - diameter converted to radius
                     continue
                 else:
-                    self.warnings.append({
+                    warnings.append({
                         "line": line_num,
                         "type": "consistency_warning",
                         "message": f"Dimension {dim}mm from input not found in output"
                     })
         
         # Enhanced shape consistency validation
-        shape_keywords = {
-            'box': ['box', 'cube', 'rectangular', 'square', 'plate'],
-            'cylinder': ['cylinder', 'rod', 'pipe', 'circular'],
-            'sphere': ['sphere', 'ball'],
-            'wedge': ['wedge', 'triangular']
-        }
-        
-        detected_shapes = []
-        for shape, keywords in shape_keywords.items():
-            if any(keyword in input_text for keyword in keywords):
-                detected_shapes.append(shape)
-        
-        for shape in detected_shapes:
-            if f'.{shape}(' not in output:
-                self.warnings.append({
+        for shape, keywords in SHAPE_KEYWORDS.items():
+            if any(keyword in input_text for keyword in keywords) and _SHAPE_TOKENS[shape] not in output:
+                warnings.append({
                     "line": line_num,
                     "type": "consistency_warning",
                     "message": f"Input mentions {shape} but output doesn't use .{shape}()"
@@ -388,8 +769,7 @@ class DatasetValidator:
         print("DATASET VALIDATION REPORT")
         print("="*60)
         
-        total_lines = sum(1 for line in open(self.dataset_path) if line.strip())
-        print(f"Total lines processed: {total_lines}")
+        print(f"Total lines processed: {self._nonempty_count}")
         print(f"Dynamic validation: {'ENABLED' if self.enable_dynamic_validation else 'DISABLED'}")
         print(f"Errors found: {len(self.errors)}")
         print(f"Warnings found: {len(self.warnings)}")
@@ -434,7 +814,10 @@ class DatasetValidator:
             print("Code syntax: VALID")
             if self.enable_dynamic_validation:
                 print("Geometry generation: ALL SUCCESSFUL")
-                print("STL export: ALL SUCCESSFUL")
+                if self.full_export_check:
+                    print("STL export: ALL SUCCESSFUL")
+                else:
+                    print("Geometry (B-rep) check: ALL PASSED")
             print("Ready for production training!")
         elif not self.errors:
             print(f"\nDATASET READY! No critical errors found.")
@@ -448,12 +831,42 @@ class DatasetValidator:
         print("="*60)
 
 
+# Per-process validator used by the worker pools in DatasetValidator
+_worker_validator: Optional[DatasetValidator] = None
+
+
+def _init_validation_worker(dataset_path: str, full_export_check: bool) -> None:
+    """Set up this worker's validator."""
+    global _worker_validator
+    _worker_validator = DatasetValidator(dataset_path, enable_dynamic_validation=False, workers=1,
+                                         full_export_check=full_export_check)
+
+
+def _validate_line_worker(args: Tuple[int, bytes, bool]) -> Tuple[List[Dict], List[Dict], List[Tuple[int, str]], int]:
+    """Validate one line in a worker; returns what the parent needs to merge."""
+    line_num, line, is_last = args
+    validator = _worker_validator
+    validator.static_valid_code = []
+    validator._nonempty_count = 0
+    errors: List[Dict] = []
+    warnings: List[Dict] = []
+    validator._validate_line(line_num, line, errors, warnings, is_last)
+    return errors, warnings, validator.static_valid_code, validator._nonempty_count
+
+
+def _dyn_worker(args: Tuple[int, str]) -> Tuple[List[Dict], List[Dict]]:
+    """Dynamically validate one output in a worker; returns its errors and warnings."""
+    return _worker_validator._validate_dynamic_one(args)
+
+
 def main():
     """Main validation function."""
     
     # Default dataset path
     dataset_path = "data/dataset.jsonl"
     enable_dynamic = True
+    workers = None
+    full_export_check = False
     
     # Parse command line arguments
     args = sys.argv[1:]
@@ -461,10 +874,18 @@ def main():
         if '--static-only' in args:
             enable_dynamic = False
             args.remove('--static-only')
+        if '--full-export-check' in args:
+            full_export_check = True
+            args.remove('--full-export-check')
+        if '--workers' in args:
+            idx = args.index('--workers')
+            if idx + 1 < len(args):
+                workers = int(args[idx + 1])
+                args = args[:idx] + args[idx + 2:]
         if args:
             dataset_path = args[0]
     
-    validator = DatasetValidator(dataset_path, enable_dynamic)
+    validator = DatasetValidator(dataset_path, enable_dynamic, workers, full_export_check)
     is_valid, errors, warnings = validator.validate()
     validator.print_report()
     